@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -5,40 +6,31 @@ import random
 from pathlib import Path
 from datetime import datetime
 
-def card_to_index(card: str):
-    """Converts a card string to a unique index or a special value for no card."""
+# Game card (rank * 4 + suit, see shed_game) -> index lookup, rank + 13 * suit (ranks start from 2, 13 ranks for each suit)
+CARD_TO_IDX = {rank * 4 + suit: rank - 2 + 13 * suit for suit in range(4) for rank in range(2, 15)}
+IDX_TO_CARD = sorted(CARD_TO_IDX, key=CARD_TO_IDX.get)
+
+
+def card_to_index(card: int):
+    """Converts a card to a unique index or a special value for no card."""
     if not card:
         return 60  # Special value indicating no card
-
-    suit_order = {'h': 0, 'd': 1, 'c': 2, 's': 3}
-    rank = int(card[1:]) - 2  # Subtract 2 since ranks start from 2
-    suit = suit_order[card[0]]
-    return rank + 13 * suit  # There are 13 ranks for each suit
+    return CARD_TO_IDX[card]
 
 
 def index_to_card(index: int):
-    """Converts an index back to a card string or a marker for no card."""
+    """Converts an index back to a card or a marker for no card."""
     if index == 60:
         return ''  # Or any other suitable representation for no card
-
-    suits = ['h', 'd', 'c', 's']
-    rank = index % 13 + 2  # Add 2 since ranks start from 2
-    suit = suits[index // 13]
-    return f"{suit}{str(rank).zfill(2)}"
+    return IDX_TO_CARD[index]
 
 
 def get_binary_indicators(cards: list):
     """Creates a 52-binary indicator array for the given list of cards."""
-    try:
-        indicators = [0] * 52
-        for card in cards:
-            if card == '#' or card is None:
-                continue
-            index = card_to_index(card)
-            indicators[index] = 1
-        return indicators
-    except Exception as e:
-        print(f"Card value: {card}, Card index: {card_to_index(card)}", e)
+    indices = np.fromiter((CARD_TO_IDX[card] for card in cards if card and card != '#'), dtype=np.int8)
+    indicators = np.zeros(52, dtype=np.float32)
+    indicators[indices] = 1
+    return indicators
 
 
 def save_to_file(filename, data):
@@ -63,20 +55,93 @@ class DQN(nn.Module):
 
 
 class AIAgent:
+    # Per-move rewards for a playable/unplayable prediction
+    CORRECT_REWARD = 1.0
+    INCORRECT_REWARD = -1.0
+
     def __init__(self, name):
         self.name = name
         # input_size = 168
         self.model = DQN(input_size=168, output_size=52)
         self.optimizer = optim.Adam(self.model.parameters(), lr=0.001)
-        self.criterion = nn.MSELoss()
         self.history = []
+        self.move_history = []  # (state, action, reward) feedback for each prediction
         self.accurate_actions = 0
         self.total_actions = 0
 
-        # If you have a GPU, move the model to GPU
-        if torch.cuda.is_available():
+        # If you have a GPU, move the model to GPU, once
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if self.device.type == 'cuda':
             print('CUDA AVAILABLE')
-            self.model.cuda()
+        self.model.to(self.device)
+        self.init_inference()
+
+    def init_inference(self):
+        """Allocates the reusable decide_move input buffers and compiles the model's forward."""
+        # Model input reused by every decide_move, only the first 53 values are ever written
+        self._state_buf = torch.zeros(1, 168, device=self.device)
+        # The round state is written through a numpy view of a host tensor; on GPU that
+        # tensor is pinned so it can be copied to _state_buf without blocking
+        if self.device.type == 'cuda':
+            self._host_state_t = torch.zeros(168, pin_memory=True)
+        else:
+            self._host_state_t = self._state_buf[0]
+        self._host_state = self._host_state_t.numpy()
+        # On GPU the inference forward is captured once and replayed on _state_buf
+        self._forward_graph = None
+        self._forward_out = None
+        # Fuse the Linear/ReLU stack on GPU, the default mode is used since the forward
+        # is already captured into our own CUDA graph
+        if self.device.type == 'cuda':
+            self._forward = torch.compile(self.model, fullgraph=True)
+        else:
+            self._forward = self.model
+
+    def __getstate__(self):
+        # Buffers share memory with each other, CUDA graphs and compiled modules can't
+        # be pickled, so they're recreated on load
+        state = self.__dict__.copy()
+        for key in ('_state_buf', '_host_state_t', '_host_state', '_forward_graph', '_forward_out', '_forward'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Agents saved before the device and per-move feedback were added
+        if 'device' not in state:
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            self.model.to(self.device)
+        self.__dict__.setdefault('move_history', [])
+        # Their history states are lists, learn_from_game_end stacks tensors
+        self.history = [(state if torch.is_tensor(state) else torch.tensor(state, dtype=torch.float32, device=self.device), action)
+                        for state, action in self.history]
+        self.init_inference()
+
+    def capture_forward_graph(self):
+        """Captures the inference forward pass on _state_buf into a CUDA graph."""
+        # Warm up on a side stream so lazy cuBLAS/allocator setup isn't recorded
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad():
+            for _ in range(3):
+                self._forward(self._state_buf)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self._forward_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._forward_graph), torch.no_grad():
+            self._forward_out = self._forward(self._state_buf)
+
+    def predict(self):
+        """Runs the model on the current contents of _state_buf."""
+        if self.device.type != 'cuda':
+            with torch.no_grad():
+                return self._forward(self._state_buf)
+
+        # Weights are updated in place by the optimizer, so the captured graph stays valid
+        if self._forward_graph is None:
+            self.capture_forward_graph()
+        self._forward_graph.replay()
+        return self._forward_out
 
 
     def decide_move(self, player_states, table_cards, playable_cards, same_cards_count):
@@ -118,22 +183,24 @@ class AIAgent:
 
         # simplified round_state
         top_card = (card_to_index(table_cards.stack_play[-1]) if len(table_cards.stack_play) > 0 else 60) / 60
-        round_state = player_hand + [top_card] + ([0] * 115)
+        self._host_state[:52] = player_hand
+        self._host_state[52] = top_card
+        if self.device.type == 'cuda':
+            self._state_buf[0].copy_(self._host_state_t, non_blocking=True)
 
-        state_tensor = torch.tensor([round_state], dtype=torch.float32)
-        if torch.cuda.is_available():
-            state_tensor = state_tensor.cuda()
-
-        with torch.no_grad():
-            predicted_action = self.model(state_tensor)
+        predicted_action = self.predict()
+        round_state = self._state_buf[0].clone()
 
         # Select the card with the highest score
+        # .item() is the one host/device sync per move, the card is needed on the host to check
+        # against playable_cards, learning is deferred to the batched game end update
         highest_score_index = predicted_action.argmax(dim=1).item()
-        predicted_card = index_to_card(highest_score_index)
+        predicted_card = IDX_TO_CARD[highest_score_index]
 
         move_was_correct = predicted_card in playable_cards
         predicted_action = get_binary_indicators([predicted_card])
-        self.learn_from_move(round_state, predicted_action, move_was_correct)
+        # Use a different reward based on whether the move was correct
+        self.move_history.append((round_state, predicted_action, self.CORRECT_REWARD if move_was_correct else self.INCORRECT_REWARD))
         
         # Check if the predicted card is in playable_cards
         if move_was_correct:
@@ -143,7 +210,7 @@ class AIAgent:
             # Fallback strategy if the predicted card is not playable
             chosen_card = [random.choice(playable_cards)]
             given_action = get_binary_indicators(chosen_card)
-            self.learn_from_move(round_state, given_action, True)
+            self.move_history.append((round_state, given_action, self.CORRECT_REWARD))
 
         self.total_actions += 1
 
@@ -153,49 +220,28 @@ class AIAgent:
         self.history.append((round_state, action))
         return chosen_card
     
-    def learn_from_move(self, last_state, last_action, move_was_correct):
-        # Convert the last state and action to tensors
-        state_tensor = torch.tensor(last_state, dtype=torch.float32)
-        action_tensor = torch.tensor(last_action, dtype=torch.float32)
-
-        if torch.cuda.is_available():
-            state_tensor = state_tensor.cuda()
-            action_tensor = action_tensor.cuda()
-
-        # Forward pass to get predictions
-        predictions = self.model(state_tensor)
-
-        # Use a different reward based on whether the move was correct
-        reward = 1.0 if move_was_correct else -1.0
-        target = torch.full(predictions.shape, reward, dtype=torch.float32)
-
-        # Calculate loss and perform backpropagation
-        loss = self.criterion(predictions, target)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-
-    
     def learn_from_game_end(self, final_reward):
         now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
-        for state, action in self.history:
-            # Convert to tensors
-            state = torch.tensor(state, dtype=torch.float32)
-            action = torch.tensor(action, dtype=torch.float32)
+        # The target in basic Q-learning is the reward of the action
+        # Here, we use final_reward as the target for the moves taken, and the per-move
+        # correct/incorrect rewards for each prediction made during the game
+        # Adjust this part if your learning strategy is different
+        samples = [(state, final_reward) for state, _ in self.history]
+        samples += [(state, reward) for state, _, reward in self.move_history]
+        if samples:
+            # Stack the game's states into one [N, 168] batch for a single update
+            # States are already float32 rows on self.device, cloned from the input buffer
+            states = torch.stack([state for state, _ in samples])
+            rewards = torch.tensor([reward for _, reward in samples], dtype=torch.float32, device=self.device)
 
             # Forward pass to get predictions
-            predictions = self.model(state)
-
-            # The target in basic Q-learning is the reward of the action
-            # Here, we use final_reward as the target since you're updating at the end of the game
-            # Adjust this part if your learning strategy is different
-            target = torch.full(predictions.shape, final_reward, dtype=torch.float32)
+            predictions = self._forward(states)
 
-            # Calculate loss (assuming Binary Cross-Entropy)
-            loss = self.criterion(predictions, target)
+            # Calculate MSE loss, broadcasting each sample's reward across its row
+            loss = (predictions - rewards[:, None]).square().mean()
 
             # Backpropagation
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
             loss.backward()
             self.optimizer.step()
 
@@ -206,3 +252,4 @@ class AIAgent:
         self.accurate_actions = 0
         self.total_actions = 0
         self.history = []
+        self.move_history = []
@@ -1,5 +1,4 @@
 from prob_model import ProbabilisticModel
-from copy import deepcopy
 import pickle
 
 class Node:
@@ -17,12 +16,14 @@ class Node:
         print(self.playable_cards)
         
     def simulate_moves(self, from_loc):
+        # Play each move on this node's model, copy the result into a child, then roll back
+        start = self.prob_model.snapshot()
         for card in self.playable_cards:
-            child = Node(deepcopy(self.prob_model), 3)
-            child.prob_model.move_card(card, from_loc, 'play_stack')
-            child.prob_model.deal_unseen(1, from_loc)
-            child.prob_model.update_probabilities()
-            self.child_nodes.append(child)
+            self.prob_model.move_card(card, from_loc, 'play_stack')
+            self.prob_model.deal_unseen(1, from_loc)
+            self.prob_model.update_probabilities()
+            self.child_nodes.append(Node(self.prob_model.copy(), 3))
+            self.prob_model.restore(start)
             
     def __eq__(self, other):
         if not isinstance(other, Node):
@@ -1,4 +1,12 @@
-from shed_game import can_play_card, magic_cards
+from enum import IntEnum
+import numpy as np
+from numba import njit
+from shed_game import can_play_card, card_from_str, magic_cards
+
+# Card string -> index lookup, rank + 13 * suit (ranks start from 2, 13 ranks for each suit)
+CARD_TO_IDX = {f"{suit}{rank:02d}": rank - 2 + 13 * i for i, suit in enumerate('hdcs') for rank in range(2, 15)}
+IDX_TO_CARD = sorted(CARD_TO_IDX, key=CARD_TO_IDX.get)
+
 
 def card_to_index(card: str):
     """Converts a card string to a unique index or a special value for no card."""
@@ -6,11 +14,7 @@ def card_to_index(card: str):
         return 60  # Special value indicating no card
     elif card == '#':
         return 52
-
-    suit_order = {'h': 0, 'd': 1, 'c': 2, 's': 3}
-    rank = int(card[1:]) - 2  # Subtract 2 since ranks start from 2
-    suit = suit_order[card[0]]
-    return rank + 13 * suit  # There are 13 ranks for each suit
+    return CARD_TO_IDX[card]
 
 
 def index_to_card(index: int):
@@ -19,135 +23,159 @@ def index_to_card(index: int):
         return '#'
     if index == 60:
         return ''  # Or any other suitable representation for no card
+    return IDX_TO_CARD[index]
+
+
+# Whether each of the 52 cards can be played on a top card of each rank, row 0 is an empty play stack
+PLAYABLE_CARD_MASK = np.zeros((15, 52), dtype=bool)
+PLAYABLE_CARD_MASK[0] = True
+for top_rank in range(2, 15):
+    # shed_game cards are rank * 4 + suit, so top_rank * 4 is a card of that rank
+    PLAYABLE_CARD_MASK[top_rank] = [can_play_card(card_from_str(card), top_rank * 4, magic_cards) for card in IDX_TO_CARD]
+
+
+class Location(IntEnum):
+    # Row of each location in ProbabilisticModel.card_probabilities
+    player_hand = 0
+    opponent_hand = 1
+    player_face_up = 2
+    opponent_face_up = 3
+    player_face_down = 4
+    opponent_face_down = 5
+    discarded = 6
+    play_stack = 7
+    deck = 8
+
+
+# Locations unseen cards can be in, in the order of update_probabilities' counts
+UNSEEN_LOCATIONS = np.array([Location.deck, Location.player_hand, Location.opponent_hand,
+                             Location.player_face_down, Location.opponent_face_down])
+
+
+@njit(cache=True)
+def spread_unseen(card_probabilities, unseen_mask, unseen_rates):
+    # Writes each unseen location's rate into the column of every card set in unseen_mask
+    for i in range(52):
+        if unseen_mask >> i & 1:
+            for j in range(UNSEEN_LOCATIONS.size):
+                card_probabilities[UNSEEN_LOCATIONS[j], i] = unseen_rates[j]
+
 
-    suits = ['h', 'd', 'c', 's']
-    rank = index % 13 + 2  # Add 2 since ranks start from 2
-    suit = suits[index // 13]
-    return f"{suit}{str(rank).zfill(2)}"
+@njit(cache=True)
+def any_playable_probability(probs, playable_indices):
+    # Probability that at least one of the playable cards is there, the complement of none being there
+    prob_no_playable_cards = 1.0
+    for i in playable_indices:
+        if probs[i] == 1.0:
+            return 1.0  # A playable card is known to be there
+        prob_no_playable_cards *= 1 - probs[i]
+    return 1 - prob_no_playable_cards
 
 
 class ProbabilisticModel:
     def __init__(self):
         # Represents the probability of each card being in each location
-        # Indexes 0-51 correspond to the 52 cards
-        # 'player_hand', 'opponent_hand', 'deck', 'discarded', 'face_up' represent the locations
-        self.card_probabilities = {
-            'player_hand': [0.0] * 52,
-            'opponent_hand': [0.0] * 52,
-            'player_face_up': [0.0] * 52,
-            'opponent_face_up': [0.0] * 52,
-            'player_face_down': [0.0] * 52,
-            'opponent_face_down': [0.0] * 52,
-            'discarded': [0.0] * 52,
-            'play_stack': [0.0] * 52,
-            'deck': [1.0] * 52  # Initially, all cards are assumed to be in the deck
-        }
-        self.unseen_cards = [1.0] * 52
-        self.deck_count = 52
-        self.player_unseen_hand_count = 0
-        self.opponent_unseen_hand_count = 0
-        self.player_face_down_count = 0
-        self.opponent_face_down_count = 0
+        # Rows are the Location of the card, columns 0-51 correspond to the 52 cards
+        self.card_probabilities = np.zeros((len(Location), 52), dtype=np.float32)
+        self.card_probabilities[Location.deck] = 1.0  # Initially, all cards are assumed to be in the deck
+        self.unseen_mask = (1 << 52) - 1  # Bit i is set while card i hasn't been seen
+        # Number of unseen cards in each Location, only the UNSEEN_LOCATIONS are ever non-zero
+        self.unseen_counts = np.zeros(len(Location), dtype=np.int32)
+        self.unseen_counts[Location.deck] = 52
 
         self.top_card = ''
+        self.aggregate_cache = None  # aggregate_probabilities() result, cleared when card_probabilities changes
+        self.state_hash = None       # __hash__() result, cleared on any change to the model
 
     def move_card(self, card_str, from_loc, to_loc):
         card_index = card_to_index(card_str)
 
-        if self.card_probabilities[from_loc][card_index] == 0.0:
+        if self.card_probabilities[Location[from_loc], card_index] == 0.0:
             raise Exception(f"Card '{card_str}' not in '{from_loc}'")
 
-        if self.unseen_cards[card_index] == 1.0:
-            self.unseen_cards[card_index] = 0.0
-
-            if from_loc == 'deck':
-                self.deck_count -= 1
-            elif from_loc == 'player_hand':
-                self.player_unseen_hand_count -= 1
-            elif from_loc == 'opponent_hand':
-                self.opponent_unseen_hand_count -= 1
-            elif from_loc == 'player_face_down':
-                self.player_face_down_count -= 1
-            elif from_loc == 'opponent_face_down':
-                self.opponent_face_down_count -= 1
+        card_bit = 1 << card_index
+        if self.unseen_mask & card_bit:
+            self.unseen_mask ^= card_bit
+            # Unseen cards only have a probability in the UNSEEN_LOCATIONS, so from_loc is one of them
+            self.unseen_counts[Location[from_loc]] -= 1
 
         if to_loc == 'play_stack': self.top_card = card_str
 
-        for loc in self.card_probabilities:
-            self.card_probabilities[loc][card_index] = 1.0 if loc == to_loc else 0.0
+        self.card_probabilities[:, card_index] = 0.0
+        self.card_probabilities[Location[to_loc], card_index] = 1.0
+        self.aggregate_cache = None
+        self.state_hash = None
 
     def move_stack(self, from_loc, to_loc):
-        for card_index, card_prob in self.card_probabilities[from_loc]:
-            if card_prob == 1.0:
-                self.move_card(index_to_card(card_index), from_loc, to_loc)
+        # Moves every card known to be in from_loc over to to_loc
+        moved = self.card_probabilities[Location[from_loc]] == 1.0
+        # Cards not seen yet go through move_card so the unseen counts stay right
+        for card_index in np.flatnonzero(moved):
+            if self.unseen_mask >> card_index & 1:
+                self.move_card(IDX_TO_CARD[card_index], from_loc, to_loc)
+
+        self.card_probabilities[:, moved] = 0.0
+        self.card_probabilities[Location[to_loc], moved] = 1.0
+        self.aggregate_cache = None
+        self.state_hash = None
+        if from_loc == 'play_stack':
+            self.top_card = ''
     
     def deal_unseen(self, no_cards, location):
         if location not in ['player_hand', 'opponent_hand', 'player_face_down', 'opponent_face_down']:
             raise Exception(f"Can't deal unseen cards to {location}")
         
-        if self.deck_count - no_cards < 0:
-            raise Exception(f"Can't deal {no_cards}, only {self.deck_count} left in the deck")
+        deck_count = self.unseen_counts[Location.deck]
+        if deck_count - no_cards < 0:
+            raise Exception(f"Can't deal {no_cards}, only {deck_count} left in the deck")
         
-        self.deck_count -= no_cards
-        if location == 'player_hand':
-            self.player_unseen_hand_count += no_cards
-        elif location == 'opponent_hand':
-            self.opponent_unseen_hand_count += no_cards
-        elif location == 'player_face_down':
-            self.player_face_down_count += no_cards
-        elif location == 'opponent_face_down':
-            self.opponent_face_down_count += no_cards
+        self.unseen_counts[Location.deck] -= no_cards
+        self.unseen_counts[Location[location]] += no_cards
+        self.state_hash = None
 
     def get_playable_probability(self, loc, top_card):
-        playable_card_probs = {}
-        for card_index, card_prob in enumerate(self.card_probabilities[loc]):
-            card_str = index_to_card(card_index)
-            if card_prob != 0 and can_play_card(card_str, top_card, magic_cards):
-                playable_card_probs[card_str] = card_prob
+        probs = self.card_probabilities[Location[loc]]
+        top_rank = int(top_card[1:]) if top_card else 0
+        playable_indices = np.flatnonzero(PLAYABLE_CARD_MASK[top_rank] & (probs != 0))
 
         # Calculate the probability of having at least one playable card
-        if not playable_card_probs:
+        if not playable_indices.size:
             return 0.0  # No playable cards
         else:
-            # Calculate the probability of not having any playable cards
-            prob_no_playable_cards = 1.0
-            for _, prob in playable_card_probs.items():
-                prob_no_playable_cards *= (1 - prob)
-            
+            # Pull the indices and probabilities out as Python numbers once, rather than
+            # indexing with a numpy scalar per card
+            playable_card_probs = dict(zip([IDX_TO_CARD[i] for i in playable_indices.tolist()], probs[playable_indices].tolist()))
+
             # The probability of having at least one playable card is the complement of having none
             # If needed make it return probabilities too, for more specific searching
-            return (1 - prob_no_playable_cards, playable_card_probs), list(playable_card_probs.keys())
+            return (any_playable_probability(probs, playable_indices), playable_card_probs), list(playable_card_probs.keys())
 
 
     def update_probabilities(self):
         # Update probabilities based on game progress and visible actions
         # This function should be called after any action in the game
-        total_unseen = sum(self.unseen_cards)
+        total_unseen = self.unseen_mask.bit_count()
         if total_unseen > 0:
-            # Update probabilities for unknown cards
-            for i in range(52):
-                # Check if the card's location is unknown (not confirmed to be in any specific location)
-                if self.unseen_cards[i] == 1.0:
-                    self.card_probabilities['deck'][i] = self.deck_count / total_unseen
-                    self.card_probabilities['player_hand'][i] = self.player_unseen_hand_count / total_unseen
-                    self.card_probabilities['opponent_hand'][i] = self.opponent_unseen_hand_count / total_unseen
-                    self.card_probabilities['player_face_down'][i] = self.player_face_down_count / total_unseen
-                    self.card_probabilities['opponent_face_down'][i] = self.opponent_face_down_count / total_unseen
-    
+            unseen_rates = self.unseen_counts[UNSEEN_LOCATIONS] / total_unseen
+            # Spread the unseen counts evenly over the cards whose location is unknown
+            # (not confirmed to be in any specific location)
+            spread_unseen(self.card_probabilities, self.unseen_mask, unseen_rates)
+            self.aggregate_cache = None
+            self.state_hash = None
+
 
     def aggregate_probabilities(self):
         """
         Aggregate the probabilities from all locations for each card into a single array.
 
         Returns:
-        - list: A list of probabilities where each element represents the aggregated probability
-                of the corresponding card being in any of the tracked locations.
+        - np.ndarray: An array of probabilities where each element represents the aggregated probability
+                of the corresponding card being in any of the tracked locations. The array is
+                cached until the probabilities change, so it shouldn't be modified.
         """
-        total_probabilities = [0.0] * 52  # Initialize an array for the aggregated probabilities
-        for i in range(52):  # Iterate over each card
-            for location in self.card_probabilities:  # Sum the probabilities across all locations
-                total_probabilities[i] += self.card_probabilities[location][i]
-        return total_probabilities
+        if self.aggregate_cache is None:
+            self.aggregate_cache = self.card_probabilities.sum(axis=0)  # Sum the probabilities across all locations
+        return self.aggregate_cache
 
     def initialize_game(self, player_hand, player_face_up, opponent_face_up):
 
@@ -168,26 +196,66 @@ class ProbabilisticModel:
         # Update probabilities for the remaining deck and opponent's hand
         self.update_probabilities()
 
+    def snapshot(self):
+        """Returns a copy of the state mutated by moves, for use with restore()."""
+        return {
+            'card_probabilities': self.card_probabilities.copy(),
+            'unseen_mask': self.unseen_mask,
+            'unseen_counts': self.unseen_counts.copy(),
+            'top_card': self.top_card
+        }
+
+    def restore(self, snapshot):
+        """Writes a snapshot() back into the model in place."""
+        self.card_probabilities[:] = snapshot['card_probabilities']
+        self.unseen_mask = snapshot['unseen_mask']
+        self.unseen_counts[:] = snapshot['unseen_counts']
+        self.top_card = snapshot['top_card']
+        self.aggregate_cache = None
+        self.state_hash = None
+
+    def copy(self):
+        model = ProbabilisticModel()
+        model.restore(self.snapshot())
+        return model
+
     def get_card_probability(self, card_str, location):
         card_index = card_to_index(card_str)
-        return self.card_probabilities[location][card_index]
+        return self.card_probabilities[Location[location], card_index]
     
+    def __getstate__(self):
+        # The caches aren't pickled, str/bytes hashes change between processes
+        state = self.__dict__.copy()
+        state['aggregate_cache'] = None
+        state['state_hash'] = None
+        return state
+
     def __eq__(self, other):
         if not isinstance(other, ProbabilisticModel):
             # don't attempt to compare against unrelated types
             return NotImplemented
+        # Models pickled before the (location, card) array layout don't have its state, so never match
+        if not hasattr(self, 'state_hash') or not hasattr(other, 'state_hash'):
+            return False
 
+        # Different hashes can't be equal, only matching hashes need the full comparison
+        if hash(self) != hash(other):
+            return False
         return (
-            self.card_probabilities == other.card_probabilities and
-            self.unseen_cards == other.unseen_cards and
-            self.deck_count == other.deck_count and
-            self.player_unseen_hand_count == other.player_unseen_hand_count and
-            self.opponent_unseen_hand_count == other.opponent_unseen_hand_count and
-            self.player_face_down_count == other.player_face_down_count and
-            self.opponent_face_down_count == other.opponent_face_down_count and
+            np.array_equal(self.card_probabilities, other.card_probabilities) and
+            self.unseen_mask == other.unseen_mask and
+            np.array_equal(self.unseen_counts, other.unseen_counts) and
             self.top_card == other.top_card
         )
 
+    def __hash__(self):
+        # Hashes the packed state, memoized until the next change so repeated lookups
+        # (e.g. of search nodes) are O(1). Don't mutate a model while it's used as a key.
+        if self.state_hash is None:
+            self.state_hash = hash((self.card_probabilities.tobytes(), self.unseen_mask,
+                                    self.unseen_counts.tobytes(), self.top_card))
+        return self.state_hash
+
 # Usage example:
 player_hand_str = ['h06', 'd03', 'c10']
 player_face_up_str = ['h05', 'd06', 'c07']
@@ -204,7 +272,7 @@ prob_model.initialize_game(player_hand_str, player_face_up_str, opponent_face_up
 # print("player_face_down sum:", round(sum(prob_model.card_probabilities['player_face_down'])))
 
 # print("Unseen Cards:")
-# print(prob_model.unseen_cards)
+# print(bin(prob_model.unseen_mask))
 
 # print("Aggregated Probabilities:")
 # print(prob_model.aggregate_probabilities())
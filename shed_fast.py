@@ -0,0 +1,210 @@
+import numpy as np
+from numba import njit, prange
+
+# Numba kernels for the shed rules, working on the same card ints (rank * 4 + suit) and
+# pile bitmasks as shed_game so they can be called from the engine or from other kernels
+
+# Move choices for playout_batch
+POLICY_RANDOM = 0
+POLICY_LOWEST = 1
+
+
+@njit(cache=True)
+def playable_mask(pile_mask, top_rank, playable):
+    # Bitmask of the cards in pile_mask that can be played on top_rank (0 for an empty play stack)
+    # playable is GameState.playable as a (15, 15) bool array, indexed [top_rank, card_rank]
+    out = 0
+    for card in range(8, 60):
+        if pile_mask >> card & 1 and playable[top_rank, card >> 2]:
+            out |= 1 << card
+    return out
+
+
+@njit(cache=True)
+def effective_top_rank(play_buf, play_len, invisible):
+    # Rank of the top card of a play stack that isn't INVISIBLE, 0 if there isn't one
+    for i in range(play_len - 1, -1, -1):
+        rank = np.int64(play_buf[i]) >> 2
+        if not invisible[rank]:
+            return rank
+    return 0
+
+
+@njit(cache=True)
+def popcount(mask):
+    # Number of set bits in mask
+    count = 0
+    while mask:
+        mask &= mask - 1
+        count += 1
+    return count
+
+
+@njit(cache=True)
+def current_pile(hand, face_up, face_down):
+    # Index (0 hand, 1 face up, 2 face down) of the pile a player plays from, -1 once they're out
+    if hand:
+        return 0
+    if face_up:
+        return 1
+    if face_down:
+        return 2
+    return -1
+
+
+@njit(cache=True, parallel=True)
+def deal_batch(deck, deck_len, piles):
+    # Deals 3 cards to each pile of every player from the end of each env's deck, like GameState.deal_cards
+    # piles is (envs, players, 3) pile bitmasks, hand/face up/face down
+    for env in prange(deck.shape[0]):
+        n = deck.shape[1]
+        for player in range(piles.shape[1]):
+            for _ in range(3):
+                for pile in range(3):
+                    n -= 1
+                    piles[env, player, pile] |= np.int64(1) << np.int64(deck[env, n])
+        deck_len[env] = n
+
+
+@njit(cache=True)
+def legal_env(env, piles, play_buf, play_len, turn, playable, invisible):
+    # Bitmask of the cards the current player of env can choose, face down cards are all
+    # allowed since they're played blind. Pickup (-1) is always allowed
+    player = turn[env]
+    pile = current_pile(piles[env, player, 0], piles[env, player, 1], piles[env, player, 2])
+    if pile == 2:
+        return piles[env, player, 2]
+    elif pile >= 0:
+        top_rank = effective_top_rank(play_buf[env], play_len[env], invisible)
+        return playable_mask(piles[env, player, pile], top_rank, playable)
+    return 0
+
+
+@njit(cache=True, parallel=True)
+def legal_batch(piles, play_buf, play_len, turn, done, playable, invisible):
+    # legal_env for every env that isn't done
+    legal = np.zeros(piles.shape[0], dtype=np.int64)
+    for env in prange(piles.shape[0]):
+        if not done[env]:
+            legal[env] = legal_env(env, piles, play_buf, play_len, turn, playable, invisible)
+    return legal
+
+
+@njit(cache=True)
+def step_env(env, action, piles, deck, deck_len, play_buf, play_len, discard, run_rank, run_len,
+             turn, turn_count, done, playable, invisible, burn_now, max_turns):
+    # Plays one action for the current player of env, a card or -1 to pick up the play stack
+    # Cards that aren't legal (see legal_env) are treated as a pickup
+    # Returns a reward of 1 if the acting player went out, sets done[env] once the game is over
+    players = piles.shape[1]
+    reward = 0.0
+    player = turn[env]
+    pile = current_pile(piles[env, player, 0], piles[env, player, 1], piles[env, player, 2])
+    top_rank = effective_top_rank(play_buf[env], play_len[env], invisible)
+    go_again = False
+
+    card_bit = np.int64(1) << np.int64(action) if action >= 8 else np.int64(0)
+    if pile < 0 or not card_bit & piles[env, player, pile]:
+        action = -1
+    elif pile == 2 and not playable[top_rank, action >> 2]:
+        # A face down card that can't be played goes into the hand with the play stack
+        piles[env, player, 2] ^= card_bit
+        piles[env, player, 0] |= card_bit
+        action = -1
+    elif pile < 2 and not playable[top_rank, action >> 2]:
+        action = -1
+
+    if action == -1:
+        for i in range(play_len[env]):
+            piles[env, player, 0] |= np.int64(1) << np.int64(play_buf[env, i])
+        play_len[env] = 0
+        run_rank[env] = 0
+        run_len[env] = 0
+    else:
+        piles[env, player, pile] ^= card_bit
+        if pile == 0 and deck_len[env]:
+            deck_len[env] -= 1
+            piles[env, player, 0] |= np.int64(1) << np.int64(deck[env, deck_len[env]])
+        play_buf[env, play_len[env]] = action
+        play_len[env] += 1
+        rank = action >> 2
+        if rank == run_rank[env]:
+            run_len[env] += 1
+        else:
+            run_rank[env] = rank
+            run_len[env] = 1
+        if burn_now[rank] or run_len[env] >= 4:
+            # Burn the play stack, the same player goes again
+            for i in range(play_len[env]):
+                discard[env] |= np.int64(1) << np.int64(play_buf[env, i])
+            play_len[env] = 0
+            run_rank[env] = 0
+            run_len[env] = 0
+            go_again = True
+
+    turn_count[env] += 1
+    if not (piles[env, player, 0] | piles[env, player, 1] | piles[env, player, 2]):
+        reward = 1.0
+        go_again = False
+
+    # Game over once at most one player has cards left, or the turn limit is hit
+    active = 0
+    for other in range(players):
+        if piles[env, other, 0] | piles[env, other, 1] | piles[env, other, 2]:
+            active += 1
+    if active <= 1 or turn_count[env] >= max_turns:
+        done[env] = True
+    elif not go_again:
+        # Next player that still has cards
+        next_player = (player + 1) % players
+        while not (piles[env, next_player, 0] | piles[env, next_player, 1] | piles[env, next_player, 2]):
+            next_player = (next_player + 1) % players
+        turn[env] = next_player
+    return reward
+
+
+@njit(cache=True, parallel=True)
+def step_batch(actions, piles, deck, deck_len, play_buf, play_len, discard, run_rank, run_len,
+               turn, turn_count, done, playable, invisible, burn_now, max_turns):
+    # step_env for every env that isn't done, returns the rewards and whether each env is now done
+    rewards = np.zeros(piles.shape[0], dtype=np.float32)
+    for env in prange(piles.shape[0]):
+        if not done[env]:
+            rewards[env] = step_env(env, actions[env], piles, deck, deck_len, play_buf, play_len, discard, run_rank,
+                                    run_len, turn, turn_count, done, playable, invisible, burn_now, max_turns)
+    return rewards, done.copy()
+
+
+@njit(cache=True, parallel=True)
+def playout_batch(seed, policy, piles, deck, deck_len, play_buf, play_len, discard, run_rank, run_len,
+                  turn, turn_count, done, playable, invisible, burn_now, max_turns):
+    # Plays every env that isn't done to the end, each player picking up when they have no legal cards
+    # Otherwise they choose uniformly at random from their legal cards with POLICY_RANDOM, or play their
+    # lowest legal card with POLICY_LOWEST (face down cards are still picked at random, they're blind)
+    # Each env's random numbers are seeded from seed + env (mod 2**32, numba's seed width), so playouts
+    # repeat for the same seed whatever the thread count
+    # Returns the first player to go out in each env, -1 if it hit max_turns first
+    first_out = np.full(piles.shape[0], -1, dtype=np.int64)
+    for env in prange(piles.shape[0]):
+        np.random.seed((seed + env) % 2**32)
+        while not done[env]:
+            legal = legal_env(env, piles, play_buf, play_len, turn, playable, invisible)
+            action = -1
+            if legal and policy == POLICY_LOWEST and piles[env, turn[env], 0] | piles[env, turn[env], 1]:
+                # Cards are ordered by rank, so the lowest set bit is a lowest ranked card
+                action = popcount((legal & -legal) - 1)
+            elif legal:
+                # Take the k-th set bit of legal
+                k = np.random.randint(0, popcount(legal))
+                for card in range(8, 60):
+                    if legal >> card & 1:
+                        if k == 0:
+                            action = card
+                            break
+                        k -= 1
+            player = turn[env]
+            reward = step_env(env, action, piles, deck, deck_len, play_buf, play_len, discard, run_rank,
+                              run_len, turn, turn_count, done, playable, invisible, burn_now, max_turns)
+            if reward and first_out[env] < 0:
+                first_out[env] = player
+    return first_out
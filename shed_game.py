@@ -1,20 +1,65 @@
 import os
 import random
-from datetime import datetime
-from enum import Enum
+from array import array
+from itertools import count
+import time
+import secrets
+from enum import IntEnum
 from pathlib import Path
 import pickle
+import numpy as np
 from AI import AIAgent
+from shed_fast import deal_batch, legal_batch, step_batch, playout_batch, POLICY_RANDOM, POLICY_LOWEST
 
-def get_card_rank(card: str):
-    # Extracts the numerical rank from a card string
-    return None if not card else int(card[1:]) 
+# Cards are ints, rank * 4 + suit, so the rank is card >> 2 and each card is its own bit
+# in the pile bitmasks, lower bits being lower ranks
+SUITS = 'hdcs'
+# Bitmask of the four cards of each rank, indexed by rank (0-15)
+RANK_MASK = tuple(0b1111 << (rank * 4) for rank in range(16))
+# Unshuffled deck, copied for every new TableCards
+FULL_DECK = tuple(range(2 * 4, 15 * 4))
+FULL_DECK_ARRAY = np.array(FULL_DECK, dtype=np.uint8)  # Shuffled by TableCards.deck_shuffle
 
 
-def can_play_card(card: str, top_card: str, magic_cards: dict):
-    card_rank = get_card_rank(card)
+def card_str(card: int):
+    # Card as a string for display and json, e.g. 'h02'
+    return f'{SUITS[card & 3]}{card >> 2:02d}'
 
-    top_card_rank = get_card_rank(top_card) if top_card else None
+
+# card_str of every card, for converting whole piles
+CARD_STRS = tuple(card_str(card) for card in range(15 * 4))
+
+
+def card_from_str(card: str):
+    return int(card[1:]) * 4 + SUITS.index(card[0])
+
+
+# Codes for the non-card actions in the action log, cards are logged as themselves
+ACTION_CODES = {'#': -1, '*': -2}
+CODE_ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+
+
+def iter_bits(mask: int):
+    # Yields the index of each set bit in mask, lowest first
+    while mask:
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
+
+
+def mask_to_cards(mask: int):
+    return list(iter_bits(mask))
+
+
+def get_card_rank(card: int):
+    # Extracts the numerical rank from a card, None for no card
+    return None if card is None else card >> 2
+
+
+def can_play_card(card: int, top_card: int, magic_cards: dict):
+    card_rank = card >> 2
+
+    top_card_rank = top_card >> 2 if top_card else None
     
     # Allow card if nothing on deck
     if not top_card_rank:
@@ -22,7 +67,7 @@ def can_play_card(card: str, top_card: str, magic_cards: dict):
 
     # Magic card rules (if the played card is a magic card)
     if card_rank in magic_cards:
-        if top_card_rank not in magic_cards[card_rank].playable_on:
+        if not magic_cards[card_rank].playable_on >> top_card_rank & 1:
             return False
 
     # Check for LOWER_THAN magic ability on the effective top card
@@ -39,97 +84,198 @@ def can_play_card(card: str, top_card: str, magic_cards: dict):
 
 
 class PlayerState:
-    # Represents a player in the game
+    # Represents a player in the game, each pile is a bitmask of cards
     def __init__(self, name: str):
         self.name = name
-        self.cards_hand = []         # Cards currently in player's hand
-        self.cards_face_up = []      # Player's face-up cards
-        self.cards_face_down = []    # Player's face-down cards
+        self.hand_mask = 0         # Cards currently in player's hand
+        self.face_up_mask = 0      # Player's face-up cards
+        self.face_down_mask = 0    # Player's face-down cards
+
+    def reset(self):
+        # Empty every pile, so the same PlayerState can be used for the next game
+        self.hand_mask = self.face_up_mask = self.face_down_mask = 0
+
+    @property
+    def cards_hand(self):
+        return mask_to_cards(self.hand_mask)
+
+    @property
+    def cards_face_up(self):
+        return mask_to_cards(self.face_up_mask)
+
+    @property
+    def cards_face_down(self):
+        return mask_to_cards(self.face_down_mask)
 
     def is_winner(self):
         # Check if the player has won (no cards left)
-        return not (self.cards_hand or self.cards_face_up or self.cards_face_down)
+        return not (self.hand_mask | self.face_up_mask | self.face_down_mask)
     
     def get_json(self):
         # Return json of the player's current state
         return {
             'name': self.name,
-            'cards_hand': self.cards_hand.copy(),
-            'cards_face_up': self.cards_face_up.copy(),
-            'cards_face_down': self.cards_face_down.copy()
+            'cards_hand': [CARD_STRS[card] for card in iter_bits(self.hand_mask)],
+            'cards_face_up': [CARD_STRS[card] for card in iter_bits(self.face_up_mask)],
+            'cards_face_down': [CARD_STRS[card] for card in iter_bits(self.face_down_mask)]
         }
 
     def __repr__(self):
+        json = self.get_json()
         string = f"Name: {self.name}\n"
-        string += f"Hand: {self.cards_hand}\n"
-        string += f"Face Up: {self.cards_face_up}\n"
-        return string + f"Face Down: {self.cards_face_down}\n"
+        string += f"Hand: {json['cards_hand']}\n"
+        string += f"Face Up: {json['cards_face_up']}\n"
+        return string + f"Face Down: {json['cards_face_down']}\n"
         
 
 class TableCards:
     # Represents the cards on the table
     def __init__(self):
         # Initialize a deck of cards, shuffle it, and prepare stacks
-        self.deck = [f'{suit}{str(i).zfill(2)}' for i in range(2, 15) for suit in ['h', 'd', 'c', 's']]
-        self.stack_discard = []  # Discarded cards stack
+        self.deck = list(FULL_DECK)
+        self.discard_mask = 0    # Discarded cards, bitmask of cards
         self.stack_play = []     # Cards currently in play
+        self.play_mask = 0       # Bitmask of the cards in stack_play
+        self.top_run_rank = None # Rank of the top card of stack_play
+        self.top_run_len = 0     # Number of cards of top_run_rank in a row at the top of stack_play
+        self.effective_top_card = None  # Top card of stack_play that isn't INVISIBLE, set by GameState.play_card
+
+    def reset(self):
+        # Put every card back in the deck, in place, ready for deck_shuffle
+        self.deck[:] = FULL_DECK
+        self.discard_mask = 0
+        self.clear_stack_play()
+
+    @property
+    def stack_discard(self):
+        return mask_to_cards(self.discard_mask)
+
+    def clear_stack_play(self):
+        # Empty the play stack, returning the bitmask of the cards that were on it
+        play_mask = self.play_mask
+        self.stack_play.clear()
+        self.play_mask = 0
+        self.top_run_rank = None
+        self.top_run_len = 0
+        self.effective_top_card = None
+        return play_mask
     
     def deck_shuffle(self, seed = None):
-        # Using datetime to generate a granular seed
-        if not seed:
-            seed = int(datetime.now().timestamp() * 1e6)
+        # A fresh random 64 bit seed unless one is given
+        if seed is None:
+            seed = secrets.randbits(64)
             
-        random.Random(seed).shuffle(self.deck)
+        # Permute in numpy and hand back plain ints, the deck is only ever popped from Python
+        # Written into the existing list, so reset and deck_shuffle keep the one deck list
+        self.deck[:] = np.random.default_rng(seed).permutation(FULL_DECK_ARRAY).tolist()
         return seed
 
     def get_json(self):
         # Return json of the table's current state
         return {
-            'deck': self.deck.copy(),
-            'stack_discard': self.stack_discard.copy(),
-            'stack_play': self.stack_play.copy()
+            'deck': [CARD_STRS[card] for card in self.deck],
+            'stack_discard': [CARD_STRS[card] for card in iter_bits(self.discard_mask)],
+            'stack_play': [CARD_STRS[card] for card in self.stack_play]
         }
 
 
-class MagicAbilities(Enum):
-    # Enumeration for different magic abilities of cards
+class MagicAbilities(IntEnum):
+    # Enumeration for different magic abilities of cards, ints so the rule checks compare plain ints
     BURN = 1
     RESET = 2
     LOWER_THAN = 3
     INVISIBLE = 4
 
 
+def ranks_mask(ranks):
+    # Bitmask with bit r set for each rank r
+    return sum(1 << rank for rank in ranks)
+
+
 class MagicCard:
     # Represents a card with a magic ability
-    def __init__(self, magic_ability: MagicAbilities, playable_on: set, is_effect_now: bool):
+    def __init__(self, magic_ability: MagicAbilities, playable_on: int, is_effect_now: bool):
         self.magic_ability = magic_ability  # The magic ability of the card
-        self.playable_on = playable_on      # Set of ranks on which the card can be played
+        self.playable_on = playable_on      # Bitmask of ranks on which the card can be played, see ranks_mask
         self.is_effect_now = is_effect_now  # If the effect of the card is immediate
 
 
+def build_magic_tables(magic_cards: dict):
+    # Flattens magic_cards into tuples indexed by rank (0-14) for the per-card rule checks
+    # Tuples rather than numpy arrays, indexing a numpy scalar from Python is slower than a dict lookup
+    is_magic = tuple(rank in magic_cards for rank in range(15))
+    # playable[top_rank][card_rank], can_play_card evaluated once for every pair of ranks
+    # Row 0 is an empty play stack, where anything can be played
+    playable = tuple(tuple(top_rank == 0 or card_rank >= 2 and can_play_card(card_rank * 4, top_rank * 4, magic_cards)
+                           for card_rank in range(15))
+                     for top_rank in range(15))
+    # 0 for ranks that aren't magic
+    magic_ability = tuple(int(magic_cards[rank].magic_ability) if rank in magic_cards else 0 for rank in range(15))
+    is_effect_now = tuple(rank in magic_cards and magic_cards[rank].is_effect_now for rank in range(15))
+    return is_magic, playable, magic_ability, is_effect_now
+
+
 class GameState:
-    def __init__(self, players: dict, magic_cards: dict):
+    game_ids = count()  # Keys of each game's game_history entry, shared by all GameStates
+
+    def __init__(self, players: dict, magic_cards: dict, record_history: bool = False):
         self.magic_cards = magic_cards
+        self.record_history = record_history  # Whether round_states snapshots are taken, for output_history
+        self.is_magic, self.playable, self.magic_ability, self.is_effect_now = build_magic_tables(magic_cards)
+        # Bitmask of every card that can be played on each top card rank, 0 for an empty play stack
+        self.playable_cards_mask = tuple(sum(RANK_MASK[rank] for rank in range(2, 15) if self.playable[top_rank][rank])
+                                         for top_rank in range(15))
+        # Bitmask of every card with a non-magic rank
+        self.non_magic_mask = sum(RANK_MASK[rank] for rank in range(2, 15) if not self.is_magic[rank])
         self.player_states = [PlayerState(player_name) for player_name in players.keys()]
+        self.index_players()
         self.table_cards = TableCards()
+        self.rng = random.Random()  # Face down card picks, seeded with each game's seed in start_game
         self.start_index = 0
         self.turn_index = 0
         self.round_index = 0
-        self.game_start_time = ''
+        self.game_id = None
+        self.game_start_time = ''  # Display label for the current game
         self.game_history = {'magic_cards': magic_cards}
+        # Current game's action log, entry i is action_codes[i] taken by player action_players[i]
+        # in round action_rounds[i], in the order they were played
+        self.action_rounds = array('i')
+        self.action_players = array('b')
+        self.action_codes = array('h')
+        self.face_down_flips = array('b')  # Face down cards turned into the hand for not being playable, in order
+        self.face_down_flip_actions = array('i')  # Index in the action log of the action each flip came before
+        self.round_states = []  # Current game's player_states/table_cards at the end of each round, if record_history
         self.same_cards_count = 0
-        self.last_cards = []
+        self.last_cards = None  # Bitmask of the cards in hands or in play at the last round start, see check_same_cards
         self.is_game_over = False
         self.winning_order = []
+        self.active_players = len(self.player_states)  # Players still holding cards
+        self.first_turn = False  # First player's opening turn, when only their lowest cards can be played
     
     def store_game_state(self):
-        self.game_history[self.game_start_time]['rounds'][self.round_index]['player_states'] = [player.get_json() for player in self.player_states]
-        self.game_history[self.game_start_time]['rounds'][self.round_index]['table_cards'] = self.table_cards.get_json()
+        if not self.record_history:
+            return
+        self.round_states[self.round_index]['player_states'] = [player.get_json() for player in self.player_states]
+        self.round_states[self.round_index]['table_cards'] = self.table_cards.get_json()
             
-    def start_game(self):
-        self.game_start_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
-        seed = self.table_cards.deck_shuffle()
-        self.game_history[self.game_start_time] = {'seed': seed, 'rounds': []}
+    def start_game(self, seed: int = None):
+        self.game_id = next(GameState.game_ids)
+        self.game_start_time = f"{time.time_ns():x}"  # Unique and sorts in start order
+        self.active_players = len(self.player_states)
+        seed = self.table_cards.deck_shuffle(seed)
+        self.rng.seed(seed)
+        # The game's entry in game_history shares the action log and round states
+        self.action_rounds = array('i')
+        self.action_players = array('b')
+        self.action_codes = array('h')
+        self.face_down_flips = array('b')
+        self.face_down_flip_actions = array('i')
+        self.round_states = []
+        # 'deal' is the piles, deck and start index once the first turn begins, see replay
+        self.game_history[self.game_id] = {'start_time': self.game_start_time, 'seed': seed, 'round_states': self.round_states,
+                                           'players': tuple(player.name for player in self.player_states),
+                                           'actions': (self.action_rounds, self.action_players, self.action_codes),
+                                           'face_down_flips': (self.face_down_flip_actions, self.face_down_flips), 'deal': None}
 
         with open('seeds.txt', 'w') as file:
             file.write(str(seed))
@@ -141,13 +287,18 @@ class GameState:
         self.create_round()
 
     def create_round(self):
-        self.game_history[self.game_start_time]['rounds'].append({player_index: [] for player_index in range(len(self.player_states))})
+        self.round_states.append({})
 
     def init_turn(self):
         # Choose the first player and set the start index
         if self.turn_index == self.start_index and self.round_index == 1:
             self.start_index = self.choose_first_player()
             self.turn_index = self.start_index
+            self.first_turn = True
+            # Starting point for replay, after any card swaps
+            self.game_history[self.game_id]['deal'] = (
+                tuple((player.hand_mask, player.face_up_mask, player.face_down_mask) for player in self.player_states),
+                tuple(self.table_cards.deck), self.start_index)
         self.check_round_start()
 
         if self.player_states[self.turn_index].is_winner():
@@ -163,6 +314,8 @@ class GameState:
     def complete_turn(self, actions=[]):
         # Round start/store logic
         player_state = self.player_states[self.turn_index]
+        append_player_actions = self.append_player_actions
+        burned = False  # Whether the player's last action this turn burnt the play stack
         # Parse actions
         for action in actions:
             match action:
@@ -170,15 +323,15 @@ class GameState:
                     pass
                 case '#':
                     # Pickup
-                    player_state.cards_hand.extend(self.table_cards.stack_play)
-                    self.table_cards.stack_play.clear()
-                    self.append_player_actions(action)
+                    player_state.hand_mask |= self.table_cards.clear_stack_play()
+                    append_player_actions(action)
+                    burned = False
                 case _:
-                    # Play card
-                    result = self.play_card(action)
-                    self.append_player_actions(action)
-                    if  result == '*' and self.get_player_last_action() != '*':
-                        self.append_player_actions('*')
+                    # Play card, the card was just logged so the player's last action can't already be '*'
+                    burned = self.play_card(action) == '*'
+                    append_player_actions(action)
+                    if burned:
+                        append_player_actions('*')
                         
         if player_state.is_winner():
             self.check_game_over()
@@ -188,32 +341,115 @@ class GameState:
             # print(f"Winning players: {self.winning_order}")
             return
 
-        # Load next player's turns
-        if actions[0] == None or self.get_player_last_action() != '*':
+        # Load next player's turns, a burn gives the same player another go
+        if actions[0] == None or not burned:
             self.next_turn()
 
+    def index_players(self):
+        # Rebuild the name -> index lookup, call whenever player_states changes
+        self.player_indices = {player.name: i for i, player in enumerate(self.player_states)}
+
     def get_player_index(self, player_name: str):
-        player_names = [player.name for player in self.player_states]
-        return player_names.index(player_name)
+        try:
+            return self.player_indices[player_name]
+        except KeyError:
+            raise ValueError(f"{player_name} is not in the game") from None
 
     def card_swap(self, player_name, cards=[]):
         player_state = self.player_states[self.get_player_index(player_name)]
-        if not cards[0] in player_state.cards_hand:
-            raise ValueError(f"{cards[0]} not in {player_name}'s hand")
-        if not cards[1] in player_state.cards_face_up:
-            raise ValueError(f"{cards[0]} not in {player_name}'s face up cards")
+        hand_bit, face_up_bit = 1 << cards[0], 1 << cards[1]
+        if not player_state.hand_mask & hand_bit:
+            raise ValueError(f"{card_str(cards[0])} not in {player_name}'s hand")
+        if not player_state.face_up_mask & face_up_bit:
+            raise ValueError(f"{card_str(cards[0])} not in {player_name}'s face up cards")
 
-        hand_index = player_state.cards_hand.index(cards[0])
-        face_up_index = player_state.cards_face_up.index(cards[1])
-        player_state.cards_hand[hand_index] = cards[1]
-        player_state.cards_face_up[face_up_index] = cards[0]
+        player_state.hand_mask ^= hand_bit | face_up_bit
+        player_state.face_up_mask ^= hand_bit | face_up_bit
 
     def append_player_actions(self, action):
-        self.game_history[self.game_start_time]['rounds'][self.round_index][self.turn_index].append(action)
+        self.action_rounds.append(self.round_index)
+        self.action_players.append(self.turn_index)
+        self.action_codes.append(ACTION_CODES.get(action, action))
+
+    def get_round_actions(self, player_index: int):
+        # A player's actions in the current round, scanning back from the end of the log
+        actions = []
+        for i in range(len(self.action_codes) - 1, -1, -1):
+            if self.action_rounds[i] != self.round_index:
+                break
+            if self.action_players[i] == player_index:
+                code = self.action_codes[i]
+                actions.append(CODE_ACTIONS.get(code, code))
+        actions.reverse()
+        return actions
     
     def get_player_last_action(self):
-        player_history = self.game_history[self.game_start_time]['rounds'][self.round_index][self.turn_index]
-        return None if not player_history else player_history[-1]
+        # Usually the last entry in the log, so this only scans past other players' actions
+        for i in range(len(self.action_codes) - 1, -1, -1):
+            if self.action_rounds[i] != self.round_index:
+                break
+            if self.action_players[i] == self.turn_index:
+                code = self.action_codes[i]
+                return CODE_ACTIONS.get(code, code)
+        return None
+
+    def replay_to(self, round_index: int):
+        # Rebuilds the current game as it was at the start of round_index on a new GameState
+        return GameState.replay(self.game_history[self.game_id], self.magic_cards, round_index)
+
+    @classmethod
+    def replay(cls, history: dict, magic_cards: dict, round_index: int = None):
+        # Rebuilds a game from its game_history entry on a new GameState, by replaying the action log
+        # from the starting deal, up to the start of round_index or to the end of the log if it's None
+        # Stall detection (same_cards_count) isn't replayed
+        deal = history['deal']
+        if deal is None:
+            raise ValueError("The game hasn't had its first turn yet")
+        piles, deck, start_index = deal
+        action_rounds, action_players, action_codes = history['actions']
+
+        game = cls({name: [] for name in history['players']}, magic_cards)
+        for player_state, (hand_mask, face_up_mask, face_down_mask) in zip(game.player_states, piles):
+            player_state.hand_mask, player_state.face_up_mask, player_state.face_down_mask = hand_mask, face_up_mask, face_down_mask
+        game.table_cards.deck = list(deck)
+
+        flip_actions, flip_cards = history['face_down_flips']
+        flip_index = 0
+        for action_index, (round_, player_index, code) in enumerate(zip(action_rounds, action_players, action_codes)):
+            if round_index is not None and round_ >= round_index:
+                break
+            flip_index = game.replay_flips(flip_actions, flip_cards, flip_index, action_index)
+            game.turn_index = player_index
+            player_state = game.player_states[player_index]
+            if code == ACTION_CODES['#']:
+                player_state.hand_mask |= game.table_cards.clear_stack_play()
+            elif code >= 0:
+                game.play_card(code)
+        if round_index is None:
+            # Flips after the last logged action, from a turn that hasn't been completed yet
+            game.replay_flips(flip_actions, flip_cards, flip_index, len(action_codes))
+
+        game.start_index = start_index
+        if round_index is None:
+            # Left on the last player to act, in the last round of the log
+            game.round_index = action_rounds[-1] if action_rounds else 1
+        else:
+            game.turn_index = start_index
+            game.round_index = round_index
+        game.is_game_over = game.active_players <= 1
+        return game
+
+    def replay_flips(self, flip_actions, flip_cards, flip_index: int, action_index: int):
+        # Turns over the face down cards flipped before action_index of the log, starting from
+        # flip flip_index, and returns the index of the first flip left
+        while flip_index < len(flip_actions) and flip_actions[flip_index] <= action_index:
+            card_bit = 1 << flip_cards[flip_index]
+            for player_state in self.player_states:
+                if player_state.face_down_mask & card_bit:
+                    player_state.face_down_mask ^= card_bit
+                    player_state.hand_mask |= card_bit
+            flip_index += 1
+        return flip_index
 
     def check_round_start(self):
         if self.turn_index == self.start_index:
@@ -225,8 +461,10 @@ class GameState:
     def check_same_cards(self):
         if self.table_cards.deck:
             return
-        current_cards = set(card for player_state in self.player_states for card in player_state.cards_hand)
-        current_cards.update(set(self.table_cards.stack_play))
+        # Which cards are in someone's hand or in play, as one bitmask
+        current_cards = self.table_cards.play_mask
+        for player_state in self.player_states:
+            current_cards |= player_state.hand_mask
 
         if current_cards == self.last_cards:
             self.same_cards_count += 1
@@ -238,160 +476,273 @@ class GameState:
             self.is_game_over = True
 
     def check_game_over(self):
-        for player_state in self.player_states:
-            if player_state.is_winner() and player_state.name not in self.winning_order:
-                self.winning_order.append(player_state.name)
-
-        if len([player_state.name for player_state in self.player_states if not player_state.is_winner()]) <= 1:
+        # Winners are counted off active_players as they go out in play_card
+        if self.active_players <= 1:
             print(f"Game over, due to winner")
             self.is_game_over = True
 
     def get_last_player_actions(self):
-        round_ = self.game_history[self.game_start_time]['rounds'][self.round_index]
         index = len(self.player_states) - 1 if self.turn_index - 1 == -1 else self.turn_index - 1
+        last_actions = self.get_round_actions(index)
             
-        if not round_[index]:
+        if not last_actions:
             raise ValueError(f"{self.player_states[index].name} has no previous turn")
-        return round_[self.turn_index] if self.get_player_last_action() == '*' else round_[index]
+        return self.get_round_actions(self.turn_index) if self.get_player_last_action() == '*' else last_actions
     
     def reset(self, new_players: dict = None):
-        # Reset game-related variables
-        self.table_cards = TableCards()  # Reset the table cards
+        # Reset game-related variables, reusing the table and player objects
+        self.table_cards.reset()         # Reset the table cards
         self.start_index = 0             # Reset the start index
         self.turn_index = 0              # Reset the turn index
         self.round_index = 0             # Reset the round index
         self.is_game_over = False        # Reset the game over state
+        self.first_turn = False          # Reset the first turn state
         self.winning_order = []          # Reset the winning order
-        self.player_states = [PlayerState(player_state.name) for player_state in self.player_states]
+        for player_state in self.player_states:
+            player_state.reset()
         self.player_states.insert(0, self.player_states.pop())
 
         # Rotate the player_states list to change the starting player
         if not new_players:
+            self.index_players()
             return
         
         # Create a queue of new players
-        new_player_queue = [PlayerState(name) for name in new_players if name not in {player.name for player in self.player_states}]
+        new_player_queue = iter([PlayerState(name) for name in new_players if name not in self.player_indices])
 
-        # Replace players who have left with new players from the queue
-        for i, player_state in enumerate(self.player_states):
+        # Replace players who have left with new players from the queue, in one pass
+        # Players who have left are dropped once the queue runs out
+        player_states = []
+        for player_state in self.player_states:
             if player_state.name not in new_players:
-                self.player_states[i] = new_player_queue.pop(0) if new_player_queue else None
-
-        # Remove None values (if any players were not replaced)
-        self.player_states = [player for player in self.player_states if player is not None]
+                player_state = next(new_player_queue, None)
+            if player_state is not None:
+                player_states.append(player_state)
 
         # Add any remaining new players to the end of the list
-        self.player_states.extend(new_player_queue)
+        player_states.extend(new_player_queue)
+        self.player_states = player_states
+        self.index_players()
 
     def choose_first_player(self):
-        lowest_cards = [self.get_lowest_card(player_state) for player_state in self.player_states]
-        min_card = min(lowest_cards)
-        return self.turn_index if min_card == 15 else lowest_cards.index(min_card)
+        # The player with the lowest non-magic rank in their hand, the earlier player on a tie
+        # Stays on turn_index if nobody has one
+        first_player, lowest_rank = self.turn_index, 15
+        for player_index, player_state in enumerate(self.player_states):
+            rank = self.get_lowest_card(player_state)
+            if rank < lowest_rank:
+                first_player, lowest_rank = player_index, rank
+        return first_player
     
     def get_lowest_card(self, player_state: PlayerState):
-        return min([card_rank for card in player_state.cards_hand if (card_rank := get_card_rank(card)) not in self.magic_cards], default=15)
+        # Lowest non-magic rank in the hand, 15 if there isn't one
+        # Bits are ordered by rank, so it's the rank of the lowest set bit
+        cards = player_state.hand_mask & self.non_magic_mask
+        return (cards & -cards).bit_length() - 1 >> 2 if cards else 15
 
     def get_playable_cards(self, player_index: int):
         player_state = self.player_states[player_index]
-        effective_top_card = self.find_effective_top_card()
-        
+
         # Filter cards for lowest if on first round
-        if self.round_index == 2 and self.start_index == self.turn_index:
-            return [card for card in player_state.cards_hand if get_card_rank(card) == self.get_lowest_card(self.player_states[self.turn_index])]
-        
-        if player_state.cards_hand:
-            return [card for card in player_state.cards_hand if can_play_card(card, effective_top_card, self.magic_cards)]
-        elif player_state.cards_face_up:
-            return [card for card in player_state.cards_face_up if can_play_card(card, effective_top_card, self.magic_cards)]
-        elif player_state.cards_face_down:
-            card = random.choice(player_state.cards_face_down)
-            if can_play_card(card, effective_top_card, self.magic_cards):
+        if self.first_turn:
+            return mask_to_cards(player_state.hand_mask & RANK_MASK[self.get_lowest_card(player_state)])
+
+        effective_top_card = self.find_effective_top_card()
+        playable_cards_mask = self.playable_cards_mask[effective_top_card >> 2 if effective_top_card else 0]
+        if player_state.hand_mask:
+            return mask_to_cards(player_state.hand_mask & playable_cards_mask)
+        elif player_state.face_up_mask:
+            return mask_to_cards(player_state.face_up_mask & playable_cards_mask)
+        elif player_state.face_down_mask:
+            card = self.rng.choice(player_state.cards_face_down)
+            if self.can_play_card(card, effective_top_card):
                 return [card]
             else:
-                player_state.cards_face_down.remove(card)
-                player_state.cards_hand.append(card)
+                card_bit = 1 << card
+                player_state.face_down_mask ^= card_bit
+                player_state.hand_mask |= card_bit
+                self.face_down_flips.append(card)
+                self.face_down_flip_actions.append(len(self.action_codes))
                 return ['#']
 
+    def can_play_card(self, card: int, top_card: int):
+        # Same rules as the module level can_play_card, looked up in this game's playable table
+        # The effective top card is never INVISIBLE, so its rank alone decides
+        return self.playable[top_card >> 2 if top_card else 0][card >> 2]
+
     def find_effective_top_card(self):
-        # Find the first card that is not an Invisible magic card
-        for card in reversed(self.table_cards.stack_play):
-            card_rank = get_card_rank(card)
-            if not (card_rank in self.magic_cards and self.magic_cards[card_rank].magic_ability == MagicAbilities.INVISIBLE):
-                return card
-        return None
+        # The first card from the top that is not an Invisible magic card, kept up to date by
+        # play_card since the play stack is only ever pushed to or cleared
+        return self.table_cards.effective_top_card
 
-    def play_card(self, card: str):
+    def play_card(self, card: int):
         # Handles the action of a player playing a card
         # Includes validation, playing the card, and checking for special conditions
+        table_cards = self.table_cards
         effective_top_card = self.find_effective_top_card()
-        if not can_play_card(card, effective_top_card, self.magic_cards):
-            raise ValueError(f"Can't play '{card}' on '{self.find_effective_top_card()}'")
+        card_rank = card >> 2
+        if not self.playable[effective_top_card >> 2 if effective_top_card else 0][card_rank]:
+            raise ValueError(f"Can't play '{card_str(card)}' on '{card_str(effective_top_card)}'")
         
         player_state = self.player_states[self.turn_index]
-        if card in player_state.cards_hand:
-            player_state.cards_hand.remove(card)
+        card_bit = 1 << card
+        if player_state.hand_mask & card_bit:
+            player_state.hand_mask ^= card_bit
             # Replace the played card from the player's hand with a new one from the deck
-            if self.table_cards.deck:
-                player_state.cards_hand.append(self.table_cards.deck.pop())
-        elif card in player_state.cards_face_up:
-            player_state.cards_face_up.remove(card)
-        elif card in player_state.cards_face_down:
-            player_state.cards_face_down.remove(card)
+            if table_cards.deck:
+                player_state.hand_mask |= 1 << table_cards.deck.pop()
+        elif player_state.face_up_mask & card_bit:
+            player_state.face_up_mask ^= card_bit
+        elif player_state.face_down_mask & card_bit:
+            player_state.face_down_mask ^= card_bit
         else:
-            raise ValueError(f"Player {self.turn_index} ({player_state.name}) doesn't have '{card}'")        
+            raise ValueError(f"Player {self.turn_index} ({player_state.name}) doesn't have '{card_str(card)}'")        
 
-        self.table_cards.stack_play.append(card)
+        # Playing a card is the only way to run out of cards
+        if player_state.is_winner():
+            self.winning_order.append(player_state.name)
+            self.active_players -= 1
+
+        table_cards.stack_play.append(card)
+        table_cards.play_mask |= card_bit
+        if self.magic_ability[card_rank] != MagicAbilities.INVISIBLE:
+            table_cards.effective_top_card = card
 
-        card_rank = get_card_rank(card)
-        if card_rank in self.magic_cards and self.magic_cards[card_rank].is_effect_now:
-            if self.magic_cards[card_rank].magic_ability == MagicAbilities.BURN:
+        if card_rank == table_cards.top_run_rank:
+            table_cards.top_run_len += 1
+        else:
+            table_cards.top_run_rank = card_rank
+            table_cards.top_run_len = 1
+        if self.is_effect_now[card_rank]:
+            if self.magic_ability[card_rank] == MagicAbilities.BURN:
                 return self.burn_play_stack()
                 
-        if self.check_last_four():
+        if table_cards.top_run_len >= 4:  # check_last_four(), inlined
             return self.burn_play_stack()
         
         return ''
 
     def check_last_four(self):
         # Check if the last four cards on the play stack are of the same rank
-        if len(self.table_cards.stack_play) < 4:
-            return False
-        return len({get_card_rank(card) for card in self.table_cards.stack_play[-4:]}) == 1
+        return self.table_cards.top_run_len >= 4
     
     def burn_play_stack(self):
         # Move all cards from the play stack to the discard stack
-        self.table_cards.stack_discard.extend(self.table_cards.stack_play)
-        self.table_cards.stack_play.clear()
+        self.table_cards.discard_mask |= self.table_cards.clear_stack_play()
         return '*'
     
     def next_turn(self):
         # Move to the next player's turn
         self.turn_index = (self.turn_index + 1) % len(self.player_states)
+        self.first_turn = False
 
     def deal_cards(self):
         # Deal initial cards to all players
         for player_state in self.player_states:
             for _ in range(3):
-                player_state.cards_hand.append(self.table_cards.deck.pop())
-                player_state.cards_face_up.append(self.table_cards.deck.pop())
-                player_state.cards_face_down.append(self.table_cards.deck.pop())
+                player_state.hand_mask |= 1 << self.table_cards.deck.pop()
+                player_state.face_up_mask |= 1 << self.table_cards.deck.pop()
+                player_state.face_down_mask |= 1 << self.table_cards.deck.pop()
 
     def output_history(self):
         Path(".\game_history").mkdir(parents=True, exist_ok=True)
-        output_filename = f".\game_history\game_{self.game_start_time}_{self.game_history[self.game_start_time]['seed']}_history_output.txt"
+        seed = self.game_history[self.game_id]['seed']
+        output_filename = f".\game_history\game_{self.game_start_time}_{seed}_history_output.txt"
         with open(output_filename, "w+") as file:
-            file.write(f"Seed: {self.game_history[self.game_start_time]['seed']}\n\n")
-            for i, round_ in enumerate(self.game_history[self.game_start_time]['rounds']):
-                file.write(f"Round {i}:\n{round_}\n\n")
+            file.write(f"Seed: {seed}\n\n")
+            # Group the action log back into each round's actions per player, cards written as strings
+            rounds = [{player_index: [] for player_index in range(len(self.player_states))} for _ in self.round_states]
+            for round_index, player_index, code in zip(self.action_rounds, self.action_players, self.action_codes):
+                rounds[round_index][player_index].append(CODE_ACTIONS[code] if code < 0 else CARD_STRS[code])
+            for i, (round_, round_state) in enumerate(zip(rounds, self.round_states)):
+                file.write(f"Round {i}:\n{round_ | round_state}\n\n")
 
         print(f"Game history written to {output_filename}")
 
+# VectorGameState.playout policy names
+PLAYOUT_POLICIES = {'random': POLICY_RANDOM, 'lowest': POLICY_LOWEST}
+
+
+class VectorGameState:
+    # Many games played in lock step by the shed_fast kernels, for AI training throughput
+    # Uses the same cards, pile bitmasks and magic card rules as GameState, simplified to player 0
+    # always starting, no lowest-card first round, no stall detection (games end after max_turns
+    # instead) and no history
+    def __init__(self, num_envs: int, magic_cards: dict, num_players: int = 2, max_turns: int = 1000):
+        # Every player is dealt 9 cards from the one 52 card deck
+        if not 2 <= num_players <= 5:
+            raise ValueError(f"num_players must be between 2 and 5, got {num_players}")
+        is_magic, playable, magic_ability, is_effect_now = build_magic_tables(magic_cards)
+        self.playable = np.array(playable, dtype=np.bool_)
+        self.invisible = np.array([ability == MagicAbilities.INVISIBLE for ability in magic_ability], dtype=np.bool_)
+        self.burn_now = np.array([now and ability == MagicAbilities.BURN for now, ability in zip(is_effect_now, magic_ability)], dtype=np.bool_)
+        self.max_turns = max_turns
+
+        # Per env state, piles[env, player] is the hand/face up/face down bitmasks of a player
+        self.piles = np.zeros((num_envs, num_players, 3), dtype=np.int64)
+        self.deck = np.zeros((num_envs, 52), dtype=np.uint8)
+        self.deck_len = np.zeros(num_envs, dtype=np.int64)
+        self.play_buf = np.zeros((num_envs, 52), dtype=np.uint8)
+        self.play_len = np.zeros(num_envs, dtype=np.int64)
+        self.discard = np.zeros(num_envs, dtype=np.int64)
+        self.run_rank = np.zeros(num_envs, dtype=np.int64)
+        self.run_len = np.zeros(num_envs, dtype=np.int64)
+        self.turn = np.zeros(num_envs, dtype=np.int64)
+        self.turn_count = np.zeros(num_envs, dtype=np.int64)
+        self.done = np.ones(num_envs, dtype=np.bool_)
+
+    def reset(self, seed=None):
+        # Shuffles and deals a new game in every env
+        for array_ in (self.piles, self.play_len, self.discard, self.run_rank, self.run_len, self.turn, self.turn_count):
+            array_.fill(0)
+        self.done.fill(False)
+        self.deck[:] = np.random.default_rng(seed).permuted(np.broadcast_to(FULL_DECK_ARRAY, self.deck.shape), axis=1)
+        deal_batch(self.deck, self.deck_len, self.piles)
+
+    def legal_actions(self):
+        # Bitmask per env of the cards its current player can play, -1 (pick up) is always allowed
+        return legal_batch(self.piles, self.play_buf, self.play_len, self.turn, self.done, self.playable, self.invisible)
+
+    def step(self, actions):
+        # Plays a card, or -1 to pick up, for the current player of every env
+        # Returns per env rewards (1 where the player went out) and which envs are done
+        return step_batch(np.asarray(actions, dtype=np.int64), self.piles, self.deck, self.deck_len, self.play_buf,
+                          self.play_len, self.discard, self.run_rank, self.run_len, self.turn, self.turn_count,
+                          self.done, self.playable, self.invisible, self.burn_now, self.max_turns)
+
+    def playout(self, seed: int = None, policy: str = 'random'):
+        # Plays every env from its current state to the end inside numba, policy is 'random' for random
+        # legal moves or 'lowest' to always play the lowest legal card
+        # A fresh random seed unless one is given, so rollouts from copies of a state don't all repeat
+        # Returns the first player to go out in each env (-1 if it hit max_turns) and its turn count
+        if policy not in PLAYOUT_POLICIES:
+            raise ValueError(f"Unknown playout policy '{policy}', expected one of {', '.join(PLAYOUT_POLICIES)}")
+        if seed is None:
+            seed = secrets.randbits(31)
+        elif not 0 <= seed < 2**32:
+            # numba seeds with 32 bits, larger seeds would repeat smaller ones
+            raise ValueError(f"Playout seed must be in [0, 2**32), got {seed}")
+        first_out = playout_batch(seed, PLAYOUT_POLICIES[policy], self.piles, self.deck, self.deck_len, self.play_buf, self.play_len,
+                                  self.discard, self.run_rank, self.run_len, self.turn, self.turn_count,
+                                  self.done, self.playable, self.invisible, self.burn_now, self.max_turns)
+        return first_out, self.turn_count.copy()
+
+
+def simulate_batch(num_games: int, magic_cards: dict, num_players: int = 2, policy: str = 'lowest', seed: int = None,
+                   max_turns: int = 1000):
+    # Deals and plays num_games headless games with VectorGameState.playout, see there for the policies
+    # Returns the first player to go out in each game (-1 if it hit max_turns) and its turn count
+    games = VectorGameState(num_games, magic_cards, num_players, max_turns)
+    games.reset(seed)
+    return games.playout(seed, policy)
+
+
 # Magic card rules
 magic_cards = {
-    2: MagicCard(MagicAbilities.RESET, set(range(2, 15)), False),
-    3: MagicCard(MagicAbilities.INVISIBLE, set(range(2, 15)), False),
-    7: MagicCard(MagicAbilities.LOWER_THAN, set(range(2, 8)), False),
-    10: MagicCard(MagicAbilities.BURN, set(range(2, 15)), True)
+    2: MagicCard(MagicAbilities.RESET, ranks_mask(range(2, 15)), False),
+    3: MagicCard(MagicAbilities.INVISIBLE, ranks_mask(range(2, 15)), False),
+    7: MagicCard(MagicAbilities.LOWER_THAN, ranks_mask(range(2, 8)), False),
+    10: MagicCard(MagicAbilities.BURN, ranks_mask(range(2, 15)), True)
 }
 
 def save_agent(agent, directory=".\\agents"):
@@ -413,7 +764,7 @@ def get_agent(name):
             
 if __name__ == '__main__':
     players = {'Ben0': [], 'Ben1': []}
-    game = GameState(players, magic_cards)
+    game = GameState(players, magic_cards, record_history=True)
     game.start_game()
 
     while not game.is_game_over:
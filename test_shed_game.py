@@ -0,0 +1,151 @@
+import contextlib
+import io
+import os
+import random
+import tempfile
+import unittest
+from itertools import count
+import numpy as np
+from shed_game import GameState, VectorGameState, magic_cards, simulate_batch
+
+FULL_DECK_MASK = sum(1 << card for card in range(2 * 4, 15 * 4))
+
+
+def location_masks(games):
+    # Every place a card can be in each env as bitmasks, shape (envs, locations)
+    slots = np.arange(52)
+    deck = np.where(slots < games.deck_len[:, None], np.int64(1) << games.deck.astype(np.int64), 0)
+    play = np.where(slots < games.play_len[:, None], np.int64(1) << games.play_buf.astype(np.int64), 0)
+    piles = games.piles.reshape(len(games.piles), -1)
+    return np.concatenate([piles, deck, play, games.discard[:, None]], axis=1)
+
+
+class TestVectorGameState(unittest.TestCase):
+
+    def assert_cards_accounted_for(self, games):
+        # Each of the 52 cards is in exactly one place, so the masks add up to 52 bits and cover the deck
+        masks = location_masks(games)
+        counts = np.unpackbits(masks.view(np.uint8), axis=1).sum(axis=1)
+        self.assertTrue((counts == 52).all())
+        self.assertTrue((np.bitwise_or.reduce(masks, axis=1) == FULL_DECK_MASK).all())
+
+    def test_random_games(self):
+        # Plays 1000 random 3 player games, checking every card after each step
+        rng = np.random.default_rng(0)
+        games = VectorGameState(1000, magic_cards, num_players=3)
+        games.reset(seed=0)
+        self.assert_cards_accounted_for(games)
+
+        bits = np.arange(60)
+        while not games.done.all():
+            legal = games.legal_actions()
+            # A random legal card, or pick up when there isn't one (and sometimes anyway)
+            legal_bits = legal[:, None] >> bits & 1
+            actions = np.argmax(rng.random(legal_bits.shape) * legal_bits, axis=1)
+            actions[(legal == 0) | (rng.random(len(legal)) < 0.05)] = -1
+            rewards, done = games.step(actions)
+            self.assert_cards_accounted_for(games)
+            self.assertTrue((done == games.done).all())
+
+        self.assertTrue((games.turn_count <= games.max_turns).all())
+
+    def test_num_players(self):
+        # Up to 5 players can be dealt 9 cards each from one deck
+        for num_players in (1, 6):
+            with self.assertRaises(ValueError):
+                VectorGameState(10, magic_cards, num_players=num_players)
+        games = VectorGameState(10, magic_cards, num_players=5)
+        games.reset(seed=0)
+        self.assert_cards_accounted_for(games)
+        self.assertTrue((games.deck_len == 52 - 5 * 9).all())
+
+    def test_playout_seed(self):
+        # Explicit seeds repeat, seeds numba would cut down to 32 bits are rejected
+        first_out, turn_count = simulate_batch(100, magic_cards, policy='random', seed=5)
+        repeat_first_out, repeat_turn_count = simulate_batch(100, magic_cards, policy='random', seed=5)
+        self.assertTrue((first_out == repeat_first_out).all() and (turn_count == repeat_turn_count).all())
+        with self.assertRaises(ValueError):
+            simulate_batch(100, magic_cards, policy='random', seed=2**32 + 5)
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        # start_game writes seeds.txt to the working directory
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def play_game(self, seed, num_players, face_down_pickups=False, pickup_chance=0.0, stop_turn=None):
+        # A random game with round snapshots, the first player swaps a card on odd seeds
+        # With face_down_pickups, players down to their face down cards pick up instead of playing,
+        # anyone else picks up instead with pickup_chance. The first turn from stop_turn on that turns a
+        # face down card over is left uncompleted
+        game = GameState({f'Player{i}': [] for i in range(num_players)}, magic_cards, record_history=True)
+        policy = random.Random(seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            game.start_game(seed)
+            if seed % 2:
+                player_state = game.player_states[0]
+                game.card_swap(player_state.name, [player_state.cards_hand[0], player_state.cards_face_up[0]])
+            for turn in count():
+                if game.is_game_over:
+                    break
+                flips = len(game.face_down_flips)
+                actions = game.init_turn()
+                if stop_turn is not None and turn >= stop_turn and len(game.face_down_flips) > flips:
+                    break
+                player_state = game.player_states[game.turn_index]
+                if face_down_pickups and actions != [None] and not player_state.hand_mask and not player_state.face_up_mask:
+                    actions = ['#']
+                elif actions != [None] and policy.random() < pickup_chance:
+                    actions = ['#']
+                game.complete_turn([policy.choice(actions)])
+        return game
+
+    def assert_rounds_replayed(self, game):
+        # The state at the start of round k is the snapshot stored at the end of round k - 1
+        for round_index in range(2, len(game.round_states)):
+            round_state = game.round_states[round_index - 1]
+            replayed = game.replay_to(round_index)
+            self.assertEqual([player.get_json() for player in replayed.player_states], round_state['player_states'])
+            self.assertEqual(replayed.table_cards.get_json(), round_state['table_cards'])
+
+    def test_replay_to_matches_snapshots(self):
+        face_down_flips = 0
+        for seed in range(20):
+            for num_players in (2, 3, 4):
+                game = self.play_game(seed, num_players)
+                face_down_flips += len(game.face_down_flips)
+                self.assert_rounds_replayed(game)
+        # Pickups after a face down card was turned over have to have been replayed
+        self.assertGreater(face_down_flips, 0)
+
+    def test_replay_to_end(self):
+        # Replaying the whole log, pickups at any time and a flip from an unfinished turn included,
+        # gives the game as it is now
+        unfinished_turns = 0
+        for seed in range(20):
+            for num_players in (2, 3, 4):
+                game = self.play_game(seed, num_players, pickup_chance=0.1, stop_turn=random.Random(seed).randrange(100))
+                self.assert_rounds_replayed(game)
+                replayed = GameState.replay(game.game_history[game.game_id], magic_cards)
+                self.assertEqual([player.get_json() for player in replayed.player_states],
+                                 [player.get_json() for player in game.player_states])
+                self.assertEqual(replayed.table_cards.get_json(), game.table_cards.get_json())
+                unfinished_turns += not game.is_game_over
+        self.assertGreater(unfinished_turns, 0)
+
+    def test_replay_face_down_pickups(self):
+        # Picking up with a playable face down card turned over isn't a flip, it stays face down
+        for seed in range(10):
+            for num_players in (2, 3):
+                game = self.play_game(seed, num_players, face_down_pickups=True)
+                self.assert_rounds_replayed(game)
+
+if __name__ == '__main__':
+    unittest.main()